@@ -22,6 +22,8 @@ setup(name='uodm',
       author_email='jc@eiwa.ag',
       license='MIT',
       py_modules=['uodm'],
+      python_requires='>=3.7',
+      install_requires=['pymongo>=3.5'],
       include_package_data=True,
       zip_safe=True
     )
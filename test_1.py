@@ -2,9 +2,16 @@
 
 from __future__ import division, print_function, unicode_literals
 
+import gc
 import posixpath
+import types
+import uuid
 
+import bson
 import pymongo
+import pytest
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 
 import uodm
 from uodm import Attr
@@ -36,6 +43,468 @@ class Person(uodm.Document):
     }
 
 
+class FakeCursor(list):
+    """Just enough of a pymongo cursor for the ODM."""
+    def __init__(self, docs, collection):
+        super().__init__(docs)
+        self.collection = collection
+
+    def batch_size(self, n):
+        self.collection.batch_sizes.append(n)
+        return self
+
+    def limit(self, n):
+        # As in MongoDB, a limit of 0 means no limit.
+        return FakeCursor(self[:n] if n else self, self.collection)
+
+class FakeCollection:
+    """In-memory collection supporting equality and $in criteria on
+    top-level fields. It records the operations it receives. bulk_write
+    does not modify the documents: tests check the recorded operations,
+    and can set bulk_matched to simulate missing documents."""
+    def __init__(self):
+        self.docs = []
+        self.writes = []
+        self.finds = []
+        self.indexes = []
+        self.batch_sizes = []
+        self.bulk_matched = None
+
+    def _match(self, doc, criteria):
+        for k, v in criteria.items():
+            if isinstance(v, dict) and '$in' in v:
+                if doc.get(k) not in v['$in']:
+                    return False
+            elif doc.get(k) != v:
+                return False
+        return True
+
+    def _project(self, doc, projection):
+        if projection is None:
+            return dict(doc)
+        return {k: v for k, v in doc.items() if projection.get(k)}
+
+    def create_index(self, keys, **kwargs):
+        self.indexes.append((keys, kwargs))
+
+    def with_options(self, **kwargs):
+        return self
+
+    def find(self, criteria, projection=None):
+        self.finds.append(criteria)
+        return FakeCursor((self._project(d, projection) for d in self.docs
+                           if self._match(d, criteria)), self)
+
+    def find_one(self, criteria, projection=None):
+        found = self.find(criteria, projection)
+        return found[0] if found else None
+
+    def insert_one(self, doc):
+        self.writes.append(('insert_one', doc))
+        self.docs.append(dict(doc, _id=len(self.docs)))
+
+    def insert_many(self, docs, ordered=True):
+        self.writes.append(('insert_many', docs))
+        errors = []
+        for i, doc in enumerate(docs):
+            if any(d['_name_'] == doc['_name_'] for d in self.docs):
+                errors.append({'index': i, 'code': 11000})
+            else:
+                self.docs.append(dict(doc, _id=len(self.docs)))
+        if errors:
+            raise pymongo.errors.BulkWriteError({'writeErrors': errors})
+
+    def update_one(self, criteria, update):
+        self.writes.append(('update_one', update))
+        matched = [d for d in self.docs if self._match(d, criteria)][:1]
+        for d in matched:
+            d.update(update['$set'])
+        return types.SimpleNamespace(acknowledged=True,
+                                     matched_count=len(matched))
+
+    def bulk_write(self, ops, ordered=True):
+        self.writes.append(('bulk_write', ops))
+        matched = len(ops) if self.bulk_matched is None else self.bulk_matched
+        return types.SimpleNamespace(acknowledged=True, matched_count=matched)
+
+class FakeRawCollection:
+    """View of a FakeCollection returning RawBSONDocument objects."""
+    def __init__(self, collection, codec_options):
+        self.collection = collection
+        self.codec_options = codec_options
+
+    def find(self, criteria):
+        return FakeCursor((RawBSONDocument(bson.encode(d),
+                                           codec_options=self.codec_options)
+                           for d in self.collection.find(criteria)),
+                          self.collection)
+
+class FakeDatabase(dict):
+    codec_options = CodecOptions()
+
+    def __missing__(self, name):
+        collection = self[name] = FakeCollection()
+        return collection
+
+    def get_collection(self, name, codec_options):
+        self.raw_codec_options = codec_options
+        return FakeRawCollection(self[name], codec_options)
+
+@pytest.fixture
+def db():
+    return FakeDatabase()
+
+@pytest.fixture
+def odm(db):
+    return uodm.ODM(db)
+
+def test_generated_init(odm):
+    assert getattr(City.__init__, '_uodm_generated', False)
+
+    c = City(odm, name='BA', population=3)
+    assert c.contents == {'name': 'BA', 'population': 3, 'ancient': False}
+
+    p = Person(odm, name='J', age=3, city=c)
+    assert p.contents['city'] == c._name_
+
+@pytest.mark.parametrize('kwargs', [
+    {'population': 3},
+    {'name': 'BA', 'population': 3, 'unknown': 1},
+])
+def test_generated_init_errors_match_generic(odm, kwargs):
+    with pytest.raises(ValueError) as generated:
+        City(odm, **kwargs)
+
+    with pytest.raises(ValueError) as generic:
+        uodm.Document.__init__(City.__new__(City), odm, **kwargs)
+
+    assert str(generated.value) == str(generic.value)
+
+def test_generated_init_without_attributes(odm):
+    class Tag(uodm.Document):
+        DB_COLLECTION = 'tags'
+        ATTRIBUTES = {}
+
+    assert Tag(odm, _name_='t').contents == {}
+
+    with pytest.raises(ValueError):
+        Tag(odm, name='x')
+
+def test_init_fallbacks():
+    class Keyword(uodm.Document):
+        DB_COLLECTION = 'keywords'
+        ATTRIBUTES = {'self': Attr(), 'class': Attr('', 1)}
+
+    assert Keyword.__init__ is uodm.Document.__init__
+
+    class Custom(City):
+        def __init__(self, odm, **kwargs):
+            kwargs.setdefault('population', 0)
+            super().__init__(odm, **kwargs)
+
+    class CustomChild(Custom):
+        pass
+
+    assert CustomChild.__init__ is Custom.__init__
+    assert CustomChild(None, name='x').population == 0
+
+    class CustomCapital(Custom):
+        ATTRIBUTES = dict(City.ATTRIBUTES, country=Attr())
+
+    capital = CustomCapital(None, name='x', country='y')
+    assert capital.contents == {'name': 'x', 'population': 0,
+                                'ancient': False, 'country': 'y'}
+
+    with pytest.raises(ValueError):
+        CustomCapital(None, name='x')
+
+    class Capital(City):
+        ATTRIBUTES = dict(City.ATTRIBUTES, country=Attr())
+
+    assert Capital.__init__ is not City.__init__
+    assert getattr(Capital.__init__, '_uodm_generated', False)
+    assert Capital(None, name='x', population=1, country='y').country == 'y'
+
+def test_batch_commit(odm, db):
+    c = odm.new(City, name='BA', population=3)
+    p = odm.new(Person, name='J', age=3, city=None)
+    del db['people'].writes[:]
+
+    with p.batch():
+        p.age = 4
+        with p.batch():
+            p.city = c
+        assert db['people'].writes == []
+
+    assert db['people'].writes == [
+        ('update_one', {'$set': {'age': 4, 'city': c._name_}})]
+    assert p.age == 4 and p.city is c
+
+def test_batch_abort(odm, db):
+    p = odm.new(Person, name='J', age=3, city=None)
+    del db['people'].writes[:]
+
+    with pytest.raises(KeyError):
+        with p.batch():
+            p.age = 4
+            raise KeyError
+
+    assert db['people'].writes == []
+    assert p.age == 3
+
+def test_odm_batch(odm, db):
+    c = odm.new(City, name='BA', population=3)
+    p = odm.new(Person, name='J', age=3, city=None)
+    del db['cities'].writes[:], db['people'].writes[:]
+
+    with pytest.raises(KeyError):
+        with odm.batch():
+            c.population = 4
+            p.age = 4
+            raise KeyError
+
+    assert c.population == 3 and p.age == 3
+    assert db['cities'].writes == db['people'].writes == []
+
+    with odm.batch():
+        c.population = 5
+        p.age = 5
+        with p.batch():
+            p.age = 6
+
+    assert db['cities'].writes == [('bulk_write', [
+        pymongo.UpdateOne({'_name_': c._name_}, {'$set': {'population': 5}})])]
+    assert db['people'].writes == [('bulk_write', [
+        pymongo.UpdateOne({'_name_': p._name_}, {'$set': {'age': 6}})])]
+    assert c.population == 5 and p.age == 6
+
+def test_new_many(odm, db):
+    cities = odm.new_many(City, [dict(name='a', population=1),
+                                 dict(name='b', population=2)])
+
+    assert [w[0] for w in db['cities'].writes] == ['insert_many']
+    assert odm.find_one(City, cities[1]._name_) is cities[1]
+    assert odm.new_many(City, []) == []
+
+def test_new_many_partial_failure(odm):
+    existing = odm.new(City, name='old', population=1)
+
+    with pytest.raises(pymongo.errors.BulkWriteError):
+        odm.new_many(City, [dict(name='new', population=2),
+                            dict(_name_=existing._name_, name='dup',
+                                 population=3)])
+
+    names = {obj.name for obj in odm._cache.values()}
+    assert names == {'old', 'new'}
+    assert odm.find_one(City, existing._name_) is existing
+
+def test_new_many_invalid_record(odm, db):
+    with pytest.raises(ValueError):
+        odm.new_many(City, [dict(name='ok', population=1), dict(name='bad')])
+
+    assert len(odm._cache) == 0
+    assert db['cities'].docs == []
+
+def test_projection(odm, db):
+    assert City._projection == {'name': 1, 'population': 1, 'ancient': 1,
+                                '_name_': 1, '_id': 0}
+
+    db['cities'].docs.append({'_id': 1, '_name_': 'x', 'name': 'X',
+                              'population': 1, 'ancient': True,
+                              'unused': 'field'})
+
+    c = odm.find_one(City, 'x')
+    assert c.contents == {'name': 'X', 'population': 1, 'ancient': True}
+    assert list(odm.find_all(City, {})) == [c]
+
+def _people_with_cities(odm):
+    cities = odm.new_many(City, [dict(name=str(i), population=i)
+                                 for i in range(3)])
+    odm.new_many(Person, [dict(name=str(i), age=i, city=c)
+                          for i, c in enumerate(cities)]
+                         + [dict(name='none', age=0, city=None)])
+    odm._hot.clear()
+    gc.collect()
+
+def test_prefetch(odm, db):
+    _people_with_cities(odm)
+    people = list(odm.find_all(Person, {}))
+    del db['cities'].finds[:]
+
+    assert len(odm.prefetch(people, 'city')) == 3
+    assert len(db['cities'].finds) == 1
+
+    odm._hot.clear()
+    gc.collect()
+
+    assert [p.city and p.city.name for p in people] == ['0', '1', '2', None]
+    assert len(db['cities'].finds) == 1
+
+    with pytest.raises(AttributeError):
+        odm.prefetch(people, 'c')
+
+    with pytest.raises(AttributeError):
+        odm.prefetch(people, ['name'])
+
+def test_find_all_eager(odm, db):
+    _people_with_cities(odm)
+    del db['cities'].finds[:]
+
+    people = list(odm.find_all(Person, {}, eager=True))
+    odm._hot.clear()
+    gc.collect()
+
+    assert [p.city and p.city.name for p in people] == ['0', '1', '2', None]
+    assert len(db['cities'].finds) == 1
+
+def test_legacy_binary_names(odm, db):
+    legacy = bson.binary.Binary(uuid.uuid1().bytes, 3)
+    db['cities'].docs.append({'_name_': legacy, 'name': 'old',
+                              'population': 1, 'ancient': True})
+    db['people'].docs.append({'_name_': 'p', 'name': 'J', 'age': 1,
+                              'city': legacy, 'is_cool': True})
+
+    p = odm.find_one(Person, 'p')
+    assert p.city.name == 'old'
+    assert p.city is odm.find_one(City, legacy)
+
+def test_hot_cache_eviction(odm):
+    odm.MAX_HOT = 2
+    names = [odm.new(City, name=str(i), population=i)._name_
+             for i in range(3)]
+
+    assert list(odm._hot) == names[1:]
+
+    odm.find_one(City, names[1])
+    assert list(odm._hot) == [names[2], names[1]]
+
+    gc.collect()
+    assert names[0] not in odm._cache
+
+def test_find_many(odm, db):
+    odm.IN_CHUNK_SIZE = 2
+    names = [c._name_ for c in odm.new_many(
+                City, [dict(name=str(i), population=i) for i in range(5)])]
+    kept = odm.find_one(City, names[0])
+    odm._hot.clear()
+    gc.collect()
+    del db['cities'].finds[:]
+
+    found = odm.find_many(City, names[::-1] + names[:1])
+    assert [c.name for c in found] == ['4', '3', '2', '1', '0', '0']
+    assert found[-1] is kept
+    assert len(db['cities'].finds) == 2
+
+    with pytest.raises(uodm.DocumentError):
+        kept.find_many([names[1], 'missing'])
+
+def test_find_all_batched(odm, db):
+    c = odm.new_many(City, [dict(name=str(i), population=i)
+                            for i in range(5)])[0]
+
+    batches = list(odm.find_all_batched(City, {}, 2))
+    assert [len(b) for b in batches] == [2, 2, 1]
+    assert db['cities'].batch_sizes == [2]
+    assert [len(b) for b in c.find_all_batched({})] == [5]
+
+    for batch_size in (None, 0, -1):
+        with pytest.raises(ValueError):
+            odm.find_all_batched(City, {}, batch_size)
+
+def test_find_raw(odm, db):
+    db.codec_options = CodecOptions(tz_aware=True)
+    c = odm.new(City, name='BA', population=3)
+
+    docs = list(odm.find_raw(City, {'name': 'BA'}))
+    assert len(docs) == 1
+    assert isinstance(docs[0], RawBSONDocument)
+    assert docs[0]['_name_'] == c._name_
+    assert db.raw_codec_options.tz_aware
+    assert db.raw_codec_options.document_class is RawBSONDocument
+
+def test_indexes(odm, db):
+    index = ('_name_', {'unique': True, 'background': True})
+    assert db['cities'].indexes == [index]
+    assert db['people'].indexes == [index]
+
+    c = odm.new(City, name='BA', population=3)
+    list(odm.find_all(City, {}))
+    c.population = 4
+    assert db['cities'].indexes == [index]
+
+    class Late(uodm.Document):
+        DB_COLLECTION = 'late'
+        ATTRIBUTES = {'name': Attr()}
+
+    assert db['late'].indexes == []
+    odm.new(Late, name='x')
+    list(odm.find_all(Late, {}))
+    assert db['late'].indexes == [index]
+
+def test_indexes_disabled(db):
+    odm = uodm.ODM(db, ensure_indexes=False)
+    odm.new(City, name='BA', population=3)
+    list(odm.find_all(City, {}))
+    assert all(not c.indexes for c in db.values())
+
+def test_ref_cache(odm, db):
+    c1 = odm.new(City, name='BA', population=3)
+    c2 = odm.new(City, name='MDP', population=1)
+    p = odm.new(Person, name='J', age=3, city=c1)
+
+    assert p.city is c1
+    p.city = c2
+    assert p.city is c2
+    assert p.contents['city'] == c2._name_
+
+    odm._hot.clear()
+    odm._cache.clear()
+    db['cities'].finds.clear()
+    assert p.city is c2
+    assert db['cities'].finds == []
+
+    with pytest.raises(TypeError):
+        p.contents['age'] = 4
+
+def test_write_missing_document(odm, db):
+    c = odm.new(City, name='BA', population=3)
+    del db['cities'].docs[:]
+
+    with pytest.raises(uodm.DocumentError):
+        c.population = 4
+    assert c.population == 3
+
+    with pytest.raises(uodm.DocumentError):
+        with c.batch():
+            c.population = 5
+    assert c.population == 3
+
+def test_odm_batch_missing_document(odm, db):
+    c = odm.new(City, name='BA', population=3)
+    p = odm.new(Person, name='J', age=3, city=None)
+    db['cities'].bulk_matched = 0
+
+    with pytest.raises(uodm.DocumentError):
+        with odm.batch():
+            c.population = 4
+            p.age = 4
+
+    assert c.population == 3 and p.age == 3
+
+def test_find_all_list(odm, db):
+    cities = [odm.new(City, name=str(i), population=i) for i in range(5)]
+
+    assert odm.find_all_list(City, {}) == cities
+    assert db['cities'].batch_sizes == []
+
+    assert odm.find_all_list(City, {}, limit=2) == cities[:2]
+    assert db['cities'].batch_sizes == [2]
+
+    for limit in (0, -1):
+        with pytest.raises(ValueError):
+            odm.find_all_list(City, {}, limit=limit)
+
+
 if __name__ == '__main__':
     import sys
 
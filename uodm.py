@@ -1,7 +1,8 @@
 """Micro-ODM for MongoDB.
 
 Features:
-  - All attribute writes are immediately commited.
+  - All attribute writes are immediately commited, unless they are
+        grouped in a batch.
   - An ODM object encapsulates the connection and allows only one object
         per document to exist at a given time.
   - Does NOT use the "_id" field. Documents are indexed by a "_name_"
@@ -14,8 +15,15 @@ Features:
 from __future__ import division, print_function, unicode_literals
 
 import weakref
-import abc
 import uuid
+import keyword
+import types
+import contextlib
+import collections
+
+import pymongo
+from bson.binary import Binary
+from bson.raw_bson import RawBSONDocument
 
 __author__ = [  "Juan Carrano <jc@eiwa.ag>",
                 "Diego Vazquez <dv@eiwa.ag>"
@@ -28,6 +36,12 @@ __license__ = """Unauthorized copying of this file, via any medium is
 class DocumentError(Exception):
     pass
 
+def _ref_name(value):
+    """Return the name of a referenced Document. The name itself is also
+    accepted."""
+    return value if isinstance(value, (str, uuid.UUID, Binary)) else (
+                value._name_ if value is not None else None)
+
 class Attr:
     """Describe a Document attribute."""
     def __init__(self, flags='', *args):
@@ -56,13 +70,133 @@ class Attr:
 
     def raw_value(self, value):
         """If the attribute is a reference, return v's name"""
-        return value if not self.reference else (
-                    value if isinstance(value, uuid.UUID) else (
-                    value._name_ if value is not None else None))
+        return value if not self.reference else _ref_name(value)
+
+def _make_descriptor(name, attr_):
+    """Create the property through which the attribute "name" of a
+    Document is accessed.
+
+    Reading a reference returns the referred Document, looked up in the
+    object's ODM context and then remembered in the object's _ref_cache,
+    unless it was already there.
+    Writing a mutable attribute commits it."""
+    if attr_.reference:
+        ref_class = attr_.ref_class
+
+        def fget(self):
+            ref_cache = self._ref_cache
+            if ref_cache is not None:
+                obj = ref_cache.get(name)
+                if obj is not None:
+                    return obj
 
-class Document(abc.ABC):
+            raw_value = self._contents[name]
+            if raw_value is None:
+                return None
+
+            obj = self._odm.find_one(ref_class, raw_value)
+            self._remember(name, obj)
+
+            return obj
+    else:
+        def fget(self):
+            return self._contents[name]
+
+    if not attr_.mutable:
+        def fset(self, value):
+            raise AttributeError("Attribute %s is read-only"%name)
+    elif attr_.reference:
+        def fset(self, value):
+            self._update({name: _ref_name(value)})
+    else:
+        def fset(self, value):
+            self._update({name: value})
+
+    return property(fget, fset)
+
+_MISSING = object()
+
+def _make_init(cls):
+    """Generate a Document.__init__ specialized for the ATTRIBUTES of cls,
+    in the same way as the dataclasses module does: each attribute is a
+    keyword argument and the contents are built without any loop.
+
+    Return None if some attribute name cannot be used as an argument."""
+    reserved = ('self', 'odm', '_name_', 'kwargs')
+    names = list(cls.ATTRIBUTES)
+
+    if any(not k.isidentifier() or keyword.iskeyword(k) or k in reserved
+           or k.startswith('_uodm_') for k in names):
+        return None
+
+    ns = {'_uodm_missing': _MISSING, '_uodm_ref_name': _ref_name}
+    params = []
+    checks = []
+    items = []
+
+    for k in names:
+        params.append('{}=_uodm_missing'.format(k))
+
+        if k in cls._defaults:
+            ns['_uodm_dflt_' + k] = cls._defaults[k]
+            checks.append(
+                "    if {0} is _uodm_missing:\n"
+                "        {0} = _uodm_dflt_{0}\n"
+                .format(k))
+        else:
+            checks.append(
+                "    if {0} is _uodm_missing:\n"
+                "        raise ValueError('Argument ´{0}´ not given and no default available')\n"
+                .format(k))
+
+        value = '_uodm_ref_name({})'.format(k) if k in cls._refs else k
+        items.append('{!r}: {}'.format(k, value))
+
+    signature = ['self', 'odm', '_name_=None']
+    if params:
+        signature.append('*')
+        signature.extend(params)
+    signature.append('**kwargs')
+
+    # Subclasses which reach this constructor through super() may have
+    # more attributes: hand everything over to the generic constructor.
+    src = ("def __init__({signature}):\n"
+           "    if type(self) is not _uodm_cls:\n"
+           "        for k, v in ({given}):\n"
+           "            if v is not _uodm_missing:\n"
+           "                kwargs[k] = v\n"
+           "        return _uodm_generic_init(self, odm, _name_, **kwargs)\n"
+           "{checks}"
+           "    if kwargs:\n"
+           "        raise ValueError('Too many keyword arguments')\n"
+           "    self._contents = {{{items}}}\n"
+           "    self._name_ = _name_ or self.generate_uuid()\n"
+           "    self._odm = odm\n"
+           "    self._pending = None\n"
+           "    self._ref_cache = None\n").format(
+                signature=', '.join(signature),
+                given=''.join('({!r}, {}), '.format(k, k) for k in names),
+                checks=''.join(checks), items=', '.join(items))
+
+    ns['_uodm_cls'] = cls
+    ns['_uodm_generic_init'] = Document.__init__
+
+    exec(src, ns)
+
+    __init__ = ns['__init__']
+    __init__.__qualname__ = cls.__qualname__ + '.__init__'
+    __init__.__doc__ = Document.__init__.__doc__
+    __init__._uodm_generated = True
+
+    return __init__
+
+class Document:
     """A Document object maps to a document in a collection.
-    All documents have a _name_ attribute consisting of a UUID.
+    All documents have a _name_ attribute consisting of a random UUID in
+    hex form. Names which are binary UUIDs, as created by older
+    versions, are still accepted: depending on the uuidRepresentation
+    configured in the client they are read either as uuid.UUID or, with
+    pymongo 4's default, as bson.Binary objects, and are used as is.
 
     Attributes can be references to other Documents. The database
     document will store the UUID of the referred document. When the
@@ -70,19 +204,12 @@ class Document(abc.ABC):
     the corresponding Document object is returned.
 
     References can be None.
-    """
 
-    @property
-    @abc.abstractmethod
-    def DB_COLLECTION(self):
-        """The name of the collection where object of this type will be
-        stored."""
-        pass
+    Subclasses must define two class attributes:
 
-    @property
-    @abc.abstractmethod
-    def ATTRIBUTES(self):
-        """Mapping from attribute name to an Attr object.
+    DB_COLLECTION: The name of the collection where object of this type
+        will be stored.
+    ATTRIBUTES: Mapping from attribute name to an Attr object.
 
         Example:
 
@@ -92,9 +219,70 @@ class Document(abc.ABC):
             'logged_in': Attr('s', False)
             'city': Attr('sr', CityClass)
             'parent': Attr('r', Parent)
-        """
-        pass
 
+    A subclass that lacks either of them is an intermediate base class,
+    which is not mapped to any collection. For example, it can define
+    ATTRIBUTES shared by subclasses that set their own DB_COLLECTION.
+
+    Each attribute is accessed through a property generated when the
+    subclass is created. Subclasses can declare "__slots__ = ()" so that
+    their instances do not carry a __dict__.
+    """
+
+    __slots__ = ('_contents', '_name_', '_odm', '_pending', '_ref_cache',
+                 '__weakref__')
+
+    # Lookup tables derived from ATTRIBUTES by __init_subclass__.
+    _attr_names = frozenset()
+    _mutable = frozenset()
+    _required = ()
+    _refs = {}
+    _defaults = {}
+    _template = {}
+
+    def __init_subclass__(cls, **kwargs):
+        """Precompute, from ATTRIBUTES, the lookup tables used when
+        creating objects, the properties through which attributes are
+        accessed and the projection used to fetch documents of this
+        class: only the declared attributes and _name_ are read back."""
+        super().__init_subclass__(**kwargs)
+
+        collection = getattr(cls, 'DB_COLLECTION', None)
+        attributes = getattr(cls, 'ATTRIBUTES', None)
+
+        if collection is not None and not isinstance(collection, str):
+            raise TypeError("%s.DB_COLLECTION must be a string"%cls.__name__)
+
+        if attributes is not None and not isinstance(attributes, dict):
+            raise TypeError("%s.ATTRIBUTES must be a dict"%cls.__name__)
+
+        if collection is None or attributes is None:
+            # Intermediate base class.
+            return
+
+        cls._attr_names = frozenset(attributes)
+        cls._mutable = frozenset(k for k, a in attributes.items() if a.mutable)
+        cls._required = tuple(k for k, a in attributes.items()
+                              if not a.has_default)
+        cls._refs = {k: a.ref_class for k, a in attributes.items()
+                     if a.reference}
+        cls._defaults = {k: a.default for k, a in attributes.items()
+                         if a.has_default}
+        cls._template = dict.fromkeys(attributes)
+
+        for k, attr_ in attributes.items():
+            if hasattr(Document, k):
+                raise ValueError("Attribute name ´%s´ is reserved"%k)
+            setattr(cls, k, _make_descriptor(k, attr_))
+
+        cls._projection = {k: 1 for k in attributes}
+        cls._projection['_name_'] = 1
+        cls._projection['_id'] = 0
+
+        # Do not replace a constructor written by the user.
+        if (cls.__init__ is Document.__init__
+                or getattr(cls.__init__, '_uodm_generated', False)):
+            cls.__init__ = _make_init(cls) or Document.__init__
 
     def __init__(self, odm, _name_ = None, **kwargs):
         """Initialize the Document with the given values. If _name_
@@ -108,95 +296,158 @@ class Document(abc.ABC):
         but rather call ODM.new or Document.new_like .
         """
 
-        self.contents = {}
-        _kwargs = dict(kwargs)
+        cls = type(self)
 
-        for k, attr_ in self.ATTRIBUTES.items():
-            if k in _kwargs:
-                value = _kwargs.pop(k)
-            elif attr_.has_default:
-                value = attr_.default
-            else:
+        for k in cls._required:
+            if k not in kwargs:
                 raise ValueError("Argument ´%s´ not given and no default available"%k)
 
-            raw_value = attr_.raw_value(value)
-
-            self.contents[k] = raw_value
+        contents = cls._template.copy()
+        contents.update(cls._defaults)
+        contents.update(kwargs)
 
-        _kwargs.pop('_id', None)
-        if _kwargs:
+        if len(contents) != len(cls._template):
             raise ValueError("Too many keyword arguments")
 
+        for k in cls._refs:
+            contents[k] = _ref_name(contents[k])
+
+        self._contents = contents
         self._name_ = _name_ or self.generate_uuid()
         self._odm = odm
+        self._pending = None
+        self._ref_cache = None
 
     @classmethod
     def generate_uuid(cls):
-        return uuid.uuid1()
+        return uuid.uuid4().hex
+
+    def _raw_document(self):
+        """Return the database representation of this object.
+
+        Since _contents is always a copy of the class _template, all the
+        documents of a class are written with the same key order:
+        _name_ first, then the attributes in ATTRIBUTES order.
+        """
+        return {"_name_": self._name_, **self._contents}
 
     def write(self):
         """Insert the document in the database. This is a low-level
         method"""
-        _doc = {"_name_": self._name_}
-        _doc.update(self.contents)
-
-        self._odm.db_conn[self.DB_COLLECTION].insert(_doc)
-
-    def __getattr__(self, name):
-        if name in self.ATTRIBUTES:
-            _attr = self.ATTRIBUTES[name]
-            raw_value = self.contents[name]
-            if _attr.reference and raw_value is not None:
-                return self._odm.find_one(_attr.ref_class, raw_value)
-            else:
-                return raw_value
-        else:
-            raise AttributeError(name)
-
-    def __setattr__(self, name, value):
-        if name in self.ATTRIBUTES:
-            _attr = self.ATTRIBUTES[name]
-
-            if not _attr.mutable:
-                raise AttributeError("Attribute %s is read-only"%name)
+        self._odm._collection(type(self)).insert_one(self._raw_document())
 
-            raw_value = _attr.raw_value(value)
-
-            # FIXME: ensure that if the db update fails, this object is
-            # not modified.
-            self._odm.db_conn[self.DB_COLLECTION].update(
-                        {"_name_":self._name_},
-                        {'$set':{name: raw_value}})
-            self.contents[name] = raw_value
-        else:
-            super().__setattr__(name, value)
+    @property
+    def contents(self):
+        """Read-only mapping from attribute name to its raw value.
+        References are stored as the name of the referred document."""
+        return types.MappingProxyType(self._contents)
 
     def __repr__(self):
         return "{}({})".format(self.__class__.__name__,
-                    ",".join("{!r}={!r}".format(*it) for it in self.contents.items()))
+                    ",".join("{!r}={!r}".format(*it) for it in self._contents.items()))
 
     def set_multiple(self, d):
         """Modify multiple values in one operation.
         This works because document-level operations in Mongo are atomic.
+
+        If a batch is active (see Document.batch and ODM.batch), the
+        values are only staged and will be commited when the batch ends.
         """
+        cls = type(self)
         raw_update = {}
 
         for k, v in d.items():
-            try:
-                _attr = self.ATTRIBUTES[k]
-            except KeyError:
-                raise AttributeError("Attribute %s not defined"%k)
+            if k not in cls._mutable:
+                if k in cls._attr_names:
+                    raise AttributeError("Attribute %s is read-only"%k)
+                else:
+                    raise AttributeError("Attribute %s not defined"%k)
 
-            if not _attr.mutable:
-                raise AttributeError("Attribute %s is read-only"%k)
+            raw_update[k] = _ref_name(v) if k in cls._refs else v
 
-            raw_value = _attr.raw_value(v)
+        self._update(raw_update)
 
-            raw_update[k] = raw_value
+    def _update(self, raw_update, saved_contents=None):
+        """Apply a mapping of raw values to this object and commit it to
+        the database, or stage it if a batch is active. This is a
+        low-level method.
 
-        self._odm.db_conn[self.DB_COLLECTION].update(
-                                {"_name_":self._name_},
-                                {'$set':raw_update})
+        saved_contents is the state to restore if an enclosing ODM batch
+        is aborted. It defaults to the current contents.
+        """
+        odm = self._odm
+        pending = self._pending
+
+        # The common case, no batch, goes first.
+        if pending is None and odm._pending is None:
+            # The object is only modified once the update has succeeded.
+            res = odm._collection(type(self)).update_one(
+                                    {"_name_":self._name_},
+                                    {'$set':raw_update})
+
+            if res.acknowledged and res.matched_count == 0:
+                raise DocumentError("Document not found in the database.")
+        elif pending is not None:
+            pending.update(raw_update)
+        else:
+            if saved_contents is None:
+                saved_contents = self._contents
+            odm._stage(self, raw_update, saved_contents)
+
+        self._contents.update(raw_update)
+
+        ref_cache = self._ref_cache
+        if ref_cache is not None:
+            for k in raw_update:
+                ref_cache.pop(k, None)
+
+    def _remember(self, name, obj):
+        """Keep obj as the resolved value of the reference "name". This
+        is a strong reference, so obj stays alive as long as this object
+        does, or until the reference is written."""
+        if self._ref_cache is None:
+            self._ref_cache = {}
+        self._ref_cache[name] = obj
+
+    def _restore(self, saved_contents):
+        """Bring back the contents saved before an aborted batch."""
+        self._contents = saved_contents
+        self._ref_cache = None
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Buffer all attribute writes and commit them in a single update
+        when the block exits:
+
+            with person.batch():
+                person.age = 31
+                person.city = other_city
+
+        If the block raises, nothing is written and the object is restored
+        to the state it had before entering. The same happens if the
+        update fails. Nested batches are merged into the outermost one.
+        """
+        if self._pending is not None:
+            yield self
+            return
+
+        saved_contents = dict(self._contents)
+        self._pending = {}
+
+        try:
+            yield self
+        except BaseException:
+            self._restore(saved_contents)
+            raise
+        finally:
+            pending, self._pending = self._pending, None
+
+        if pending:
+            try:
+                self._update(pending, saved_contents)
+            except BaseException:
+                self._restore(saved_contents)
+                raise
 
     def find_one(self, _name_):
         """Find one document of the same type in the same ODM context as
@@ -204,17 +455,41 @@ class Document(abc.ABC):
         """
         return self._odm.find_one(type(self), _name_)
 
-    def find_all(self, criteria):
+    def find_all(self, criteria, batch_size=None, eager=False):
         """Find all document of the same type which match "criteria"
         in the same ODM context as this object.
+
+        See ODM.find_all for the meaning of batch_size and eager.
+        """
+        return self._odm.find_all(type(self), criteria, batch_size, eager)
+
+    def find_all_list(self, criteria, limit=None):
+        """Like find_all, but return a list of at most limit documents.
+        """
+        return self._odm.find_all_list(type(self), criteria, limit)
+
+    def find_all_batched(self, criteria, batch_size=1000):
+        """Like find_all, but yield lists of up to batch_size documents.
+        """
+        return self._odm.find_all_batched(type(self), criteria, batch_size)
+
+    def find_many(self, names):
+        """Find many documents of the same type by name in the same ODM
+        context as this object.
         """
-        return self._odm.find_all(type(self), criteria)
+        return self._odm.find_many(type(self), names)
 
     def new_like(self, **kwargs):
         """Create a new object of the same type of this object in the
         same ODM context"""
         return self._odm.new(type(self), **kwargs)
 
+def _all_subclasses(cls):
+    """Yield all direct and indirect subclasses of cls."""
+    for sub in cls.__subclasses__():
+        yield sub
+        yield from _all_subclasses(sub)
+
 class ODM:
     """ODM context.
 
@@ -223,63 +498,358 @@ class ODM:
     exists at any given time. This is the reason for using UUIDs instead
     of Mongo's _id field, which is guaranteed to be unique only within
     one collection.
+
+    The cache holds weak references, but the MAX_HOT most recently used
+    objects are also kept alive, so that they are not reloaded from the
+    database each time user code lets go of them.
     """
-    def __init__(self, db_conn):
+
+    MAX_HOT = 4096
+    IN_CHUNK_SIZE = 1000
+
+    def __init__(self, db_conn, write_concern=None, ensure_indexes=True):
         """db_conn must be a mongo database. Example:
             client = pymongo.MongoClient(connection_uri)[db_name]
+
+        write_concern, if given, is a pymongo.WriteConcern used for bulk
+        writes (ODM.new_many and ODM.batch). For example, WriteConcern(w=0)
+        makes them fire-and-forget, at the cost of not detecting errors.
+
+        If ensure_indexes is True, a unique index on _name_ is created for
+        the collection of every Document subclass, and for classes defined
+        later, on their first use. Set it to False if the database user
+        cannot create indexes, or if they are managed elsewhere.
         """
         self.db_conn = db_conn
+        self.write_concern = write_concern
+        self.ensure_indexes = ensure_indexes
         self._cache = weakref.WeakValueDictionary()
+        self._hot = collections.OrderedDict()
+        self._pending = None
+        self._indexed = set()
+        self._collections = {}
+
+        if ensure_indexes:
+            for cls in _all_subclasses(Document):
+                if getattr(cls, 'DB_COLLECTION', None) is not None:
+                    self._ensure_index(cls)
+
+    def _ensure_index(self, cls):
+        """Create a unique index on the _name_ field of the collection of
+        cls, unless it was already done by this ODM or index creation is
+        disabled."""
+        if self.ensure_indexes and cls.DB_COLLECTION not in self._indexed:
+            self.db_conn[cls.DB_COLLECTION].create_index('_name_', unique=True,
+                                                         background=True)
+            self._indexed.add(cls.DB_COLLECTION)
+
+    def _collection(self, cls):
+        """Return the collection of cls, making sure it is indexed. Classes
+        defined after this ODM was created are indexed on first use.
+
+        Collection objects are kept, because creating them on each access
+        through db_conn is comparatively expensive."""
+        try:
+            return self._collections[cls.DB_COLLECTION]
+        except KeyError:
+            pass
+
+        self._ensure_index(cls)
+        collection = self._collections[cls.DB_COLLECTION] = \
+                                            self.db_conn[cls.DB_COLLECTION]
+
+        return collection
+
+    def _bulk_collection(self, name):
+        """Return the collection with the given name, configured with the
+        write concern for bulk writes."""
+        collection = self.db_conn[name]
+
+        if self.write_concern is not None:
+            collection = collection.with_options(
+                                        write_concern=self.write_concern)
+
+        return collection
 
     def find_one(self, cls, _name_):
-        """Find a document by name. If more or less than one document is
-        found, raise a DocumentError.
+        """Find a document by name. If no document is found, raise a
+        DocumentError. There cannot be more than one, because _name_ has
+        a unique index.
 
         cls: A class derived from Document
         _name_: a UUID.
         """
         try:
-            obj = self._cache[_name_]
+            obj = self._hot[_name_]
+        except KeyError:
+            pass
+        else:
+            self._hot.move_to_end(_name_)
             return obj
+
+        try:
+            obj = self._cache[_name_]
         except KeyError:
             pass
+        else:
+            self._touch(obj)
+            return obj
 
-        cursor = self.db_conn[cls.DB_COLLECTION].find({'_name_':_name_})
+        d = self._collection(cls).find_one({'_name_':_name_},
+                                           projection=cls._projection)
 
-        if cursor.count() == 0:
+        if d is None:
             raise DocumentError("No such document.")
-        elif cursor.count() != 1:
-            raise DocumentError("More than one document with the same _name_. Possible DB corruption.")
 
-        d = cursor[0]
         return self._new(cls, **d)
 
-    def find_all(self, cls, criteria):
+    def find_all(self, cls, criteria, batch_size=None, eager=False):
         """Return an iterable yielding all matching documents.
 
         cls: A class derived from Document
         criteria: search criteria like the one used in mongo's find()
             method.
+        batch_size: number of documents fetched from the server per
+            round-trip. If None, the server chooses, which is usually
+            the best option.
+        eager: if True, all results are fetched before yielding the first
+            one and their references are resolved with ODM.prefetch.
         """
-        cursor = self.db_conn[cls.DB_COLLECTION].find(criteria)
+        cursor = self._collection(cls).find(criteria,
+                                            projection=cls._projection)
+
+        if batch_size is not None:
+            cursor = cursor.batch_size(batch_size)
+
+        if eager:
+            objs = [self._get_or_new(cls, d) for d in cursor]
+            self.prefetch(objs)
+            yield from objs
+            return
 
         for d in cursor:
-            try:
-                obj = self._cache[d['_name_']]
-                yield obj
-                continue
-            except KeyError:
-                pass
+            yield self._get_or_new(cls, d)
+
+    def find_all_list(self, cls, criteria, limit=None):
+        """Return a list with all matching documents, or at most limit of
+        them.
+
+        When limit is given, the whole result arrives in the first batch
+        from the server, which for small results is faster than iterating
+        over find_all. The price is that all the documents are held in
+        memory at once, so use find_all for large results.
+
+        limit must be None or a positive integer, or ValueError is raised.
+        Note that MongoDB would treat a limit of 0 as no limit at all.
+        """
+        if limit is not None and (not isinstance(limit, int) or limit < 1):
+            raise ValueError("limit must be None or a positive integer")
+
+        cursor = self._collection(cls).find(criteria,
+                                            projection=cls._projection)
 
-            yield self._new(cls, **d)
+        if limit is not None:
+            cursor = cursor.limit(limit).batch_size(limit)
+
+        return [self._get_or_new(cls, d) for d in cursor]
+
+    def find_raw(self, cls, criteria, batch_size=None):
+        """Return an iterable yielding all matching documents as
+        RawBSONDocument objects, without creating Document objects.
+
+        Fields are only decoded when they are accessed, so this is much
+        cheaper than find_all for passing documents somewhere else. The
+        results are not registered in the cache.
+
+        See ODM.find_all for the meaning of the arguments.
+        """
+        self._ensure_index(cls)
+        codec_options = self.db_conn.codec_options.with_options(
+                                            document_class=RawBSONDocument)
+        collection = self.db_conn.get_collection(cls.DB_COLLECTION,
+                                                 codec_options=codec_options)
+
+        cursor = collection.find(criteria)
+
+        if batch_size is not None:
+            cursor = cursor.batch_size(batch_size)
+
+        return cursor
+
+    def find_all_batched(self, cls, criteria, batch_size=1000):
+        """Return an iterable yielding lists of up to batch_size matching
+        documents. The cursor fetches batch_size documents per round-trip,
+        so that each list corresponds to one batch from the server.
+
+        This is useful to process results in bulk, for example with
+        ODM.prefetch, ODM.new_many or ODM.batch.
+
+        batch_size must be a positive integer, or ValueError is raised.
+        """
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError("batch_size must be a positive integer")
+
+        return self._batches(self.find_all(cls, criteria, batch_size),
+                             batch_size)
+
+    @staticmethod
+    def _batches(objs, batch_size):
+        """Group the iterable objs into lists of up to batch_size items."""
+        batch = []
+
+        for obj in objs:
+            batch.append(obj)
+
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    def prefetch(self, objs, attr_names=None):
+        """Load the documents referenced by objs using one query per
+        referenced class, so that accessing those references does not
+        go to the database.
+
+        objs: An iterable of Document objects.
+        attr_names: Name, or iterable of names, of the reference
+            attributes to load. If None, all reference attributes are
+            loaded. Names which are not references raise AttributeError.
+
+        Each referring object keeps its resolved references, so they are
+        not looked up again while it is alive.
+
+        Return a list with the objects which had to be fetched from the
+        database.
+        """
+        if isinstance(attr_names, str):
+            attr_names = (attr_names,)
+
+        if attr_names is not None:
+            attr_names = set(attr_names)
+
+        wanted = collections.OrderedDict()
+
+        for obj in objs:
+            if attr_names is None:
+                names = obj._refs
+            else:
+                names = attr_names
+
+                unknown = names.difference(obj._refs)
+                if unknown:
+                    raise AttributeError(
+                        "Attribute %s of %s is not a reference"%(
+                                    min(unknown), type(obj).__name__))
+
+            for k in names:
+                ref_class = obj._refs[k]
+                raw_value = obj._contents[k]
+
+                if raw_value is not None:
+                    wanted.setdefault(ref_class, {}).setdefault(
+                                                raw_value, []).append((obj, k))
+
+        loaded = []
+
+        for ref_class, referrers in wanted.items():
+            found = {}
+            missing = []
+
+            for _name_ in referrers:
+                ref = self._cache.get(_name_)
+                if ref is None:
+                    missing.append(_name_)
+                else:
+                    found[_name_] = ref
+
+            for ref in self._find_names(ref_class, missing):
+                found[ref._name_] = ref
+                loaded.append(ref)
+
+            for _name_, ref in found.items():
+                for obj, k in referrers[_name_]:
+                    obj._remember(k, ref)
+
+        return loaded
+
+    def find_many(self, cls, names):
+        """Find documents by name. Those not in the cache are fetched with
+        one query per IN_CHUNK_SIZE names. If any of them is not found,
+        raise a DocumentError.
+
+        cls: A class derived from Document
+        names: an iterable of UUIDs.
+
+        Return a list with the objects, in the same order as names.
+        """
+        names = list(names)
+        found = {}
+        missing = []
+
+        for _name_ in names:
+            obj = self._cache.get(_name_)
+            if obj is None:
+                missing.append(_name_)
+            else:
+                self._touch(obj)
+                found[_name_] = obj
+
+        for obj in self._find_names(cls, list(set(missing))):
+            found[obj._name_] = obj
+
+        try:
+            return [found[_name_] for _name_ in names]
+        except KeyError:
+            raise DocumentError("No such document.")
+
+    def _find_names(self, cls, names):
+        """Yield the objects with the given names, using one $in query per
+        IN_CHUNK_SIZE names. Names which do not exist are skipped."""
+        collection = self._collection(cls)
+
+        for i in range(0, len(names), self.IN_CHUNK_SIZE):
+            cursor = collection.find(
+                            {'_name_': {'$in': names[i:i+self.IN_CHUNK_SIZE]}},
+                            projection=cls._projection)
+
+            for d in cursor:
+                yield self._get_or_new(cls, d)
+
+    def _get_or_new(self, cls, d):
+        """Return the cached object for the document d, or create one
+        if it is not in the cache."""
+        try:
+            obj = self._cache[d['_name_']]
+        except KeyError:
+            return self._new(cls, **d)
+
+        self._touch(obj)
+        return obj
+
+    def _touch(self, obj):
+        """Mark obj as the most recently used object, evicting the least
+        recently used one from the hot cache if it is full."""
+        hot = self._hot
+        hot[obj._name_] = obj
+        hot.move_to_end(obj._name_)
+
+        if len(hot) > self.MAX_HOT:
+            hot.popitem(last=False)
 
     def _new(self, cls, **kwargs):
         """Create a new object and register it in the cache.
         """
         obj = cls(self, **kwargs)
-        self._cache[obj._name_] = obj
+        self._register(obj)
         return obj
 
+    def _register(self, obj):
+        """Add obj to the cache."""
+        self._cache[obj._name_] = obj
+        self._touch(obj)
+
     def new(self, cls, **kwargs):
         """Create a new object, register it in the cache and commit it
         to the database.
@@ -290,3 +860,101 @@ class ODM:
         obj = self._new(cls, **kwargs)
         obj.write()
         return obj
+
+    def new_many(self, cls, records):
+        """Create many new objects, register them in the cache and commit
+        them to the database with a single insert_many.
+
+        cls: A class derived from Document
+        records: An iterable of kwargs dictionaries, one per object.
+
+        Objects are only registered in the cache once they have been
+        inserted. If some of the documents cannot be inserted, the others
+        are registered and pymongo's BulkWriteError is re-raised. Its
+        "details" attribute tells which inserts failed. On any other
+        error, no object is registered.
+        """
+        objs = [cls(self, **kw) for kw in records]
+
+        if not objs:
+            return objs
+
+        docs = [obj._raw_document() for obj in objs]
+
+        self._ensure_index(cls)
+
+        try:
+            self._bulk_collection(cls.DB_COLLECTION).insert_many(docs,
+                                                                 ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            failed = {err['index'] for err in e.details.get('writeErrors', ())}
+            for i, obj in enumerate(objs):
+                if i not in failed:
+                    self._register(obj)
+            raise
+
+        for obj in objs:
+            self._register(obj)
+
+        return objs
+
+    def _stage(self, obj, raw_update, saved_contents):
+        """Record an update to be commited at the end of the current
+        ODM batch."""
+        try:
+            _, pending = self._pending[obj]
+        except KeyError:
+            self._pending[obj] = (dict(saved_contents), dict(raw_update))
+        else:
+            pending.update(raw_update)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Buffer attribute writes to all documents in this context and
+        commit them with one bulk_write per collection when the block
+        exits.
+
+        If the block raises, nothing is written and all modified objects
+        are restored to the state they had before entering. They are also
+        restored if a bulk_write fails or some of the documents are not
+        found, although in that case the updates to other documents may
+        already have been applied in the database. Nested batches are
+        merged into the outermost one.
+        """
+        if self._pending is not None:
+            yield self
+            return
+
+        self._pending = collections.OrderedDict()
+
+        try:
+            yield self
+        except BaseException:
+            for obj, (saved_contents, _) in self._pending.items():
+                obj._restore(saved_contents)
+            raise
+        finally:
+            pending, self._pending = self._pending, None
+
+        ops = collections.OrderedDict()
+        for obj, (_, raw_update) in pending.items():
+            ops.setdefault(obj.DB_COLLECTION, []).append(
+                    pymongo.UpdateOne({"_name_":obj._name_},
+                                      {'$set':raw_update}))
+
+        try:
+            missing = 0
+
+            for collection, coll_ops in ops.items():
+                res = self._bulk_collection(collection).bulk_write(coll_ops,
+                                                               ordered=False)
+                if res.acknowledged:
+                    missing += len(coll_ops) - res.matched_count
+
+            if missing:
+                raise DocumentError(
+                        "%d documents not found in the database."%missing)
+        except BaseException:
+            for obj, (saved_contents, _) in pending.items():
+                obj._restore(saved_contents)
+            raise